@@ -8,8 +8,6 @@ Copyright (c) 2020, Joseph Ernest. See also LICENSE file.
 ==TODO==
 * implement a logfile
 
-* when backing up, use compiled regexp for the exclusion list
-* move decrypt flist thread at the top
 * use a pandas dataframe for .files, export as json (with values encrypted of course) every 10s instead of flist.write() at each turn
 * ability to sort by modification time when restoring or backing up
 * switch from pysftp to paramiko, as the former is abandonned (security risk?)
@@ -18,8 +16,13 @@ Copyright (c) 2020, Joseph Ernest. See also LICENSE file.
 * investigate how to implement incremental backups
 """
 
-import pysftp, getpass, paramiko, glob, os, hashlib, io, Crypto.Random, Crypto.Protocol.KDF, Crypto.Cipher.AES, uuid, zlib, time, pprint, sys, contextlib, threading, re
+import pysftp, getpass, paramiko, os, stat, base64, hashlib, io, Crypto.Random, Crypto.Protocol.KDF, Crypto.Cipher.AES, uuid, zlib, pprint, sys, contextlib, threading, re, concurrent.futures, queue, operator, functools
 from tqdm import tqdm
+try:  # optional: AES-GCM through OpenSSL (AES-NI + CLMUL), much faster than PyCryptodome
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.exceptions import InvalidTag
+except ImportError:
+    Cipher = None
 
 NULL16BYTES, NULL32BYTES = b'\x00' * 16, b'\x00' * 32
 BLOCKSIZE = 16*1024*1024  # 8 MB
@@ -29,33 +32,122 @@ SMALL_FILE = 1048576 # 1024*1024*1  # threadings skips smaller files
 red = "\033[91m"
 yel = "\033[93m"
 rst = "\033[0m"  # reset color
+B64MARKER = '.b64'  # present on backups whose chunks are named in url-safe base64 (22 chars) rather than hex (32 chars)
+FILENAMEDICT = (  # preset dictionary to deflate the filenames of .files items. NEVER CHANGE IT: existing items can only be read with it
+    b'.tmp.log.bak.cfg.ini.xml.json.yaml.csv.txt.md.html.css.js.py.c.h.cpp.java.go.rs.sh.exe.dll.so.zip.gz.tar.7z.rar.iso'
+    b'.pdf.doc.docx.xls.xlsx.ppt.pptx.odt.svg.psd.raw.cr2.nef.dng.heic.tif.bmp.gif.png.jpeg.JPG.wav.flac.ogg.m4a.mp3.avi.mkv.mov.MOV.MP4'
+    b'/node_modules//site-packages//__pycache__//.git//src//lib//bin//build//test//docs//assets//images//Photos//Pictures//Music//Videos/'
+    b'/Downloads//Documents//Desktop//Projects//backup//archive//data//2021//2022//2023//2024//2025/IMG_DSC_Screenshot .jpg')
 
 @contextlib.contextmanager  
 def nullcontext():  # from contextlib import nullcontext for Python 3.7+
     yield None
 
-def get_size(path):
-    try: return os.path.getsize(path)
-    except FileNotFoundError: return 4096
+def walk(path=''):
+    """
+    yields (fn, fsize, mtime, isdir) for all files and directories under `path`, like
+    glob.glob('**', recursive=True) does (hidden files skipped, symlinks followed),
+    but with a single stat() per entry
+    """
+    try:
+        it = os.scandir(path or '.')
+    except OSError:  # ex: permission denied
+        return
+    with it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            fn = os.path.join(path, entry.name)
+            try:
+                st = entry.stat()
+            except OSError:  # ex: broken symlink
+                yield fn, 4096, None, False
+                continue
+            isdir = stat.S_ISDIR(st.st_mode)
+            yield fn, st.st_size, st.st_mtime_ns, isdir
+            if isdir:
+                yield from walk(fn)
 
 def getsha256(f):
     sha256 = hashlib.sha256()
-    with open(f, 'rb') as g:
+    with open(f, 'rb', buffering=0) as g:
+        fsize = os.fstat(g.fileno()).st_size
+        if fsize > SMALL_FILE and hasattr(os, 'posix_fadvise'):  # larger kernel read-ahead: disk reads overlap with hashing
+            os.posix_fadvise(g.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buf = bytearray(min(BLOCKSIZE, max(fsize, 65536)))  # reused for every block, no bytes allocated per read
+        view = memoryview(buf)
         while True:
-            block = g.read(BLOCKSIZE)
-            if not block:
+            n = g.readinto(buf)
+            if not n:
                 break
-            sha256.update(block)
+            sha256.update(view[:n])
     return sha256.digest()
 
-_KEYCACHE = dict()
+def scryptsaltcheck(salt):
+    return hashlib.sha256(b'nFreezer scrypt salt' + salt[:12]).digest()[:4]
 
 def KDF(pwd, salt=None):
+    """
+    scrypt for the salts generated by this version, which end with a 4-byte checksum of
+    their first 12 bytes; PBKDF2 for the fully random salts of older versions (one in 2**32
+    of those would pass the check, and then fail to decrypt with 'Incorrect key')
+    """
     if salt is None:
-        salt = Crypto.Random.new().read(16)
-    key = Crypto.Protocol.KDF.PBKDF2(pwd, salt, count=100*1000)
+        salt = Crypto.Random.new().read(12)
+        salt += scryptsaltcheck(salt)
+    if salt[12:] == scryptsaltcheck(salt):
+        key = hashlib.scrypt(pwd.encode(), salt=salt, n=2**14, r=8, p=1, maxmem=64*1024*1024, dklen=16)
+    else:
+        key = Crypto.Protocol.KDF.PBKDF2(pwd, salt, count=100*1000)
     return key, salt
 
+@functools.lru_cache(maxsize=None)
+def derivekey(pwd, salt):
+    """cached KDF: each (password, salt) is derived once per run, safely from several threads"""
+    return KDF(pwd, salt)[0]
+
+def KDFs(salts, pwd):
+    """derives the keys for several salts at once: one KDF per unique salt, computed in parallel"""
+    salts = list(set(salts))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as pool:
+        return dict(zip(salts, pool.map(lambda salt: derivekey(pwd, salt), salts)))
+
+def aesgcm(key, nonce, tag=None):
+    """
+    returns (update, finalize) for an AES-GCM stream: encrypts if `tag` is None
+    (finalize returns the tag), else decrypts (finalize raises ValueError on a bad tag);
+    update() writes into a buffer reused from call to call, and returns a view of it
+    that is only valid until the next call
+    """
+    buf = bytearray()
+    if Cipher is None:
+        cipher = Crypto.Cipher.AES.new(key, Crypto.Cipher.AES.MODE_GCM, nonce=nonce)
+        process = cipher.encrypt if tag is None else cipher.decrypt
+        def update_into(block, buf):
+            process(block, output=memoryview(buf)[:len(block)])
+            return len(block)
+        finalize = cipher.digest if tag is None else lambda: cipher.verify(tag)
+    elif tag is None:
+        ctx = Cipher(algorithms.AES(key), modes.GCM(nonce)).encryptor()
+        update_into = ctx.update_into
+        def finalize():
+            ctx.finalize()
+            return ctx.tag
+    else:
+        ctx = Cipher(algorithms.AES(key), modes.GCM(nonce)).decryptor()
+        update_into = ctx.update_into
+        def finalize():
+            try:
+                ctx.finalize_with_tag(tag)  # tag only checked here: a truncated chunk fails like a corrupted one (ValueError)
+            except InvalidTag:
+                raise ValueError('MAC check failed')
+    def update(block):
+        nonlocal buf
+        if len(buf) < len(block) + 15:  # cryptography's update_into() wants block_size - 1 bytes of slack
+            buf = bytearray(len(block) + 15)
+        return memoryview(buf)[:update_into(block, buf)]
+    return update, finalize
+
 def encrypt(f=None, s=None, key=None, salt=None, out=None, pbar=None):
     if out is None:
         out = io.BytesIO()
@@ -65,20 +157,20 @@ def encrypt(f=None, s=None, key=None, salt=None, out=None, pbar=None):
     out.write(salt)
     out.write(nonce)
     out.write(NULL16BYTES)  # placeholder for tag
-    cipher = Crypto.Cipher.AES.new(key, Crypto.Cipher.AES.MODE_GCM, nonce=nonce)
+    update, finalize = aesgcm(key, nonce)
     while True:
         block = f.read(BLOCKSIZE)
         if not block:
             break
-        out.write(cipher.encrypt(block))
+        out.write(update(block))
         if pbar is not None:
-            pbar.update(BLOCKSIZE)
+            pbar.update(len(block))
     out.seek(32)
-    out.write(cipher.digest())  # tag
+    out.write(finalize())  # tag
     out.seek(0)
     return out
 
-def decrypt(f=None, s=None, pwd=None, out=None, pbar=None):
+def decrypt(f=None, s=None, pwd=None, out=None, pbar=None, key=None):
     if out is None:
         out = io.BytesIO()
     if f is None:
@@ -86,33 +178,67 @@ def decrypt(f=None, s=None, pwd=None, out=None, pbar=None):
     salt = f.read(16)
     nonce = f.read(16)
     tag = f.read(16)
-    if salt not in _KEYCACHE:
-        _KEYCACHE[salt] = KDF(pwd, salt)[0]
-    cipher = Crypto.Cipher.AES.new(_KEYCACHE[salt], Crypto.Cipher.AES.MODE_GCM, nonce=nonce)    
+    if key is None:
+        key = derivekey(pwd, salt)
+    update, finalize = aesgcm(key, nonce, tag)
     while True:
         block = f.read(BLOCKSIZE)
         if not block:
             break
-        out.write(cipher.decrypt(block))
+        out.write(update(block))
         if pbar is not None:
-            pbar.update(BLOCKSIZE)
+            pbar.update(len(block))
     try:
-        cipher.verify(tag)
+        finalize()
     except ValueError:
         print('Incorrect key or file corrupted.')
     out.seek(0)
     return out
 
 def newdistantfileblock(chunkid, mtime, fsize, h, fn, key=None, salt=None):
-    newdistantfile = zlib.compress(chunkid + mtime.to_bytes(8, byteorder='little', signed=False) + fsize.to_bytes(8, byteorder='little') + h + fn.encode())
+    prefix = chunkid + mtime.to_bytes(8, byteorder='little', signed=False) + fsize.to_bytes(8, byteorder='little') + h  # always 64 bytes, incompressible (ids, sizes, hash)
+    fn = fn.encode()
+    newdistantfile = b'\x00' + prefix + fn  # tag b'\x00': filename stored as is (a zlib stream, as written by older versions, always starts with b'\x78')
+    if len(fn) >= 32:  # tag b'\x02': filename deflated with FILENAMEDICT, kept if smaller; 1 KB window and memLevel=1: cheap to set up for such tiny inputs
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -10, 1, zdict=FILENAMEDICT)
+        zfn = compressor.compress(fn) + compressor.flush()
+        if len(zfn) < len(fn):
+            newdistantfile = b'\x02' + prefix + zfn
     s = encrypt(s=newdistantfile, key=key, salt=salt).read()    
     return (len(s)).to_bytes(4, byteorder='little') + s
 
-def readdistantfileblock(s, encryptionpwd):
-    distantfile = zlib.decompress(decrypt(s=s, pwd=encryptionpwd).read())
+def readdistantfileblock(s, key_by_salt):
+    distantfile = decrypt(s=s, key=key_by_salt[s[:16]]).read()
+    if distantfile[:1] == b'\x00':
+        distantfile = distantfile[1:]
+    elif distantfile[:1] == b'\x02':
+        distantfile = distantfile[1:65] + zlib.decompressobj(-15, zdict=FILENAMEDICT).decompress(distantfile[65:])
+    else:  # older versions: the whole item is compressed
+        distantfile = zlib.decompress(distantfile)
     chunkid, mtime, fsize, h, fn = distantfile[:16], int.from_bytes(distantfile[16:24], byteorder='little', signed=False), int.from_bytes(distantfile[24:32], byteorder='little'), distantfile[32:64], distantfile[64:].decode()
     return chunkid, mtime, fsize, h, fn
 
+def chunkname(chunkid, b64):
+    return base64.urlsafe_b64encode(chunkid).rstrip(b'=').decode() if b64 else chunkid.hex()
+
+def chunkfromname(name, b64):
+    return base64.urlsafe_b64decode(name + '==') if b64 else bytes.fromhex(name)
+
+def flistitems(data):
+    """
+    yields the (encrypted) items of the content of a .files, each one prefixed by its length;
+    slices a memoryview instead of reading the lengths and items into temporary bytes
+    """
+    mv = memoryview(data)
+    off = 0
+    while off < len(mv):
+        length = int.from_bytes(mv[off:off+4], byteorder='little')
+        if off + 4 + length > len(mv):
+            print(red + 'An item of the remote file list (.files) is corrupt, ignored. Last sync interrupted?' + rst)
+            break
+        yield bytes(mv[off+4:off+4+length])
+        off += 4 + length
+
 def parseaddress(addr):
     if '@' in addr:
         user, r = addr.split('@', 1)  # split on first occurence
@@ -122,50 +248,81 @@ def parseaddress(addr):
     return False, None, None, addr       # not remote in all other cases
 
 
-def threaded_upload(lock, fn, pbar, chunkid, flist,
-        REQUIREDCHUNKS, DISTANTHASHES,
+@contextlib.contextmanager
+def pooledconnection(connections, host, user, sftppwd, extra_arg, path):
+    """
+    borrows an sftp connection from the `connections` queue, and only opens a new
+    one if they are all busy: the SSH handshake is done once per worker, not once per file
+    """
+    try:
+        sftp = connections.get_nowait()
+    except queue.Empty:
+        sftp = pysftp.Connection(host, username=user, password=sftppwd, **extra_arg)
+        if sftp.isdir(path):
+            sftp.chdir(path)
+    try:
+        yield sftp
+    except BaseException:
+        sftp.close()  # might be broken, not given back
+        raise
+    connections.put(sftp)
+
+def closeconnections(connections):
+    while not connections.empty():
+        connections.get_nowait().close()
+
+
+def countworkers(pbar, lock, n):
+    """
+    adds `n` to the number of busy workers displayed before `pbar.label`; the new
+    description is only drawn at the next refresh, not while holding the lock
+    """
+    with lock:
+        pbar.workers += n
+        pbar.set_description_str(f'{pbar.workers} {pbar.label}', refresh=False)
+
+
+def threaded_upload(lock, fn, pbar, chunkid, b64,
         mtime, fsize, h, key, salt,
-        host, user, sftppwd, extra_arg, remotepath):
+        connections, host, user, sftppwd, extra_arg, remotepath):
     """
-    if file is large, then create a new thread with a new sftp connection
-    to send it
+    if file is large, it is sent from a worker thread, with an sftp
+    connection from the `connections` pool; returns its .files item, to be
+    written by the main thread (the main sftp connection must not be used
+    from several threads)
     """
-    with pysftp.Connection(host,
-                           username=user,
-                           password=sftppwd,
-                           **extra_arg) as sftp:
-        if sftp.isdir(remotepath):
-            sftp.chdir(remotepath)
-            with sftp.open(chunkid.hex() + '.tmp', 'wb') as f_enc, open(fn, 'rb') as f:
+    countworkers(pbar, lock, 1)
+    try:
+        with pooledconnection(connections, host, user, sftppwd, extra_arg, remotepath) as sftp:
+            with sftp.open(chunkname(chunkid, b64) + '.tmp', 'wb') as f_enc, open(fn, 'rb') as f:
+                f_enc.set_pipelined(True)  # don't wait for each write to be acknowledged: encryption overlaps with the transfer
                 encrypt(f, key=key, salt=salt, out=f_enc, pbar=pbar)
-                sftp.rename(chunkid.hex() + '.tmp', chunkid.hex())
-    with lock:
-        REQUIREDCHUNKS.add(chunkid)
-        DISTANTHASHES[h] = chunkid
-        flist.write(newdistantfileblock(chunkid=chunkid, mtime=mtime, fsize=fsize, h=h, fn=fn, key=key, salt=salt))
-    pbar.desc = str(int(pbar.desc[0])-1) + pbar.desc[1:]
-    return True
+            sftp.rename(chunkname(chunkid, b64) + '.tmp', chunkname(chunkid, b64))  # after close(), which reports any failed pipelined write
+    finally:
+        countworkers(pbar, lock, -1)
+    return newdistantfileblock(chunkid=chunkid, mtime=mtime, fsize=fsize, h=h, fn=fn, key=key, salt=salt)
 
 
-def threaded_restore(f2, lock, pbar, chunkid, mtime, fn,
-        host, user, sftppwd, encryptionpwd, extra_arg, path, fsize):
+def threaded_restore(f2, lock, pbar, chunkid, b64, mtime, fn,
+        connections, host, user, sftppwd, encryptionpwd, extra_arg, path, fsize):
     """
-    create a new thread to download and decrypt a file when restoring
+    download and decrypt a large file from a worker thread when restoring,
+    with an sftp connection from the `connections` pool (None if restoring from a local path)
     """
+    countworkers(pbar, lock, 1)
     tqdm.write(f'Restoring {fn}')
-    with pysftp.Connection(host,
-                           username=user,
-                           password=sftppwd,
-                           **extra_arg) as sftp:
-        if sftp.isdir(path):
-            sftp.chdir(path)
-        with sftp.open(chunkid.hex(), 'rb') as g:
-            with open(f2, 'wb') as f:
-                decrypt(g, pwd=encryptionpwd, out=f)
-    with lock:
-        os.utime(f2, ns=(os.stat(f2).st_atime_ns, mtime))
+    try:
+        with nullcontext() if connections is None else pooledconnection(connections, host, user, sftppwd, extra_arg, path) as sftp:
+            with (open if sftp is None else sftp.open)(chunkname(chunkid, b64), 'rb') as g:
+                if sftp is not None:
+                    g.prefetch()  # all read requests sent at once instead of one round-trip per 32 KB; sized from a stat() of the chunk, not from fsize (the file may have shrunk before it was uploaded)
+                with open(f2, 'wb') as f:
+                    decrypt(g, pwd=encryptionpwd, out=f)
+        with lock:
+            os.utime(f2, ns=(os.stat(f2).st_atime_ns, mtime))
+    finally:
+        countworkers(pbar, lock, -1)
     pbar.update(fsize)
-    pbar.desc = str(int(pbar.desc[0])-1) + pbar.desc[1:]
     return True
 
 
@@ -214,28 +371,26 @@ def backup(src=None, dest=None, sftppwd=None, encryptionpwd=None, exclusion_list
                 DISTANTFILES = dict()
                 DISTANTHASHES = dict()
                 distantfilenames = set(sftp.listdir())
-                DISTANTCHUNKS = {bytes.fromhex(f) for f in distantfilenames if '.' not in f}  # discard .files and .tmp files
+                b64 = B64MARKER in distantfilenames or '.files' not in distantfilenames  # new backups name chunks in base64, existing hex ones stay in hex
+                if b64 and B64MARKER not in distantfilenames:
+                    with sftp.open(B64MARKER, 'wb'):
+                        pass
+                DISTANTCHUNKS = {chunkfromname(f, b64) for f in distantfilenames if '.' not in f and len(f) == (22 if b64 else 32)}  # discard .files, .tmp and foreign files
                 print("Removing old .tmp files...")
                 for f in distantfilenames:
                     if f.endswith('.tmp'):
                         sftp.remove(f)
-                flist = io.BytesIO()
                 if sftp.isfile('.files'):
-                    sftp.getfo('.files', flist)
-                    flist.seek(0)
-                    while True:
-                        le = flist.read(4)
-                        if not le:
-                            break
-                        length = int.from_bytes(le, byteorder='little')
-                        s = flist.read(length)
-                        if len(s) != length:
-                            print('Item of .files is corrupt. Last sync interrupted?')
-                            break                    
-                        chunkid, mtime, fsize, h, fn = readdistantfileblock(s, encryptionpwd)
-                        DISTANTFILES[fn] = [chunkid, mtime, fsize, h]
-                        if DISTANTFILES[fn][0] == NULL16BYTES:  # deleted
-                            del DISTANTFILES[fn]
+                    with sftp.open('.files', 'rb') as flist:
+                        flist.prefetch()
+                        buf = list(flistitems(flist.read()))
+                    key_by_salt = KDFs([s[:16] for s in buf], encryptionpwd)
+                    for s in buf:
+                        chunkid, mtime, fsize, h, fn = readdistantfileblock(s, key_by_salt)
+                        if chunkid == NULL16BYTES:  # deleted
+                            DISTANTFILES.pop(fn, None)
+                        else:
+                            DISTANTFILES[fn] = (chunkid, mtime, fsize, h)
                         if chunkid in DISTANTCHUNKS:
                             DISTANTHASHES[h] = chunkid      # DISTANTHASHES[sha256_noencryption] = chunkid ; even if deleted file keep the sha256, it might be useful for moved/renamed files
                 else:
@@ -251,84 +406,112 @@ def backup(src=None, dest=None, sftppwd=None, encryptionpwd=None, exclusion_list
                 ####### SEND FILES
                 REQUIREDCHUNKS = set()
                 with sftp.open('.files', 'a+') as flist:
-                    temp_file_list = sorted(set(glob.glob('**', recursive=True)),
-                                            key=get_size,
+                    temp_file_list = sorted(walk(),
+                                            key=operator.itemgetter(1),  # fsize, already known from walk(): no stat() during the sort
                                             reverse=larger_files_first)
                     local_file_list = []
-                    for fn in temp_file_list:
-                        cnt = 0
-                        for item in exclusion_list:
-                            if item in fn:
-                                cnt += 1
-                        if cnt != 0:
-                            print('Exclusion rule match "' + item + '": ' + fn)
+                    exclusion_re = re.compile('|'.join(re.escape(item) for item in exclusion_list)) if exclusion_list else None  # all the rules in one pass per file
+                    for x in temp_file_list:
+                        m = exclusion_re.search(x[0]) if exclusion_re is not None else None
+                        if m is not None:
+                            print('Exclusion rule match "' + m.group(0) + '": ' + x[0])
                         else:
-                            local_file_list.append(fn)
-                    total_size = sum([get_size(x) for x in local_file_list])
-                    with tqdm(total=total_size, unit_scale=True, unit_divisor=1024, dynamic_ncols=True, smoothing=0.8, unit="B", mininterval=1, desc="0 nFreezer") as pbar:
-                        threads = []
-                        lock = threading.Lock()
-                        for fn in local_file_list:
-                            fsize = get_size(fn)
-                            if os.path.isdir(fn):
-                                pbar.update(fsize)
-                                continue
-                            try:
-                                mtime = os.stat(fn).st_mtime_ns
-                            except FileNotFoundError:
-                                tqdm.write(f"{yel}NFS: {fn}{rst}")  # not found, skipping
-                                pbar.update(fsize)
-                                continue
-                            if fn in DISTANTFILES and DISTANTFILES[fn][1] >= mtime and DISTANTFILES[fn][2] == fsize:
-                                tqdm.write(f'US: {fn}')  # unmodified, skipping
-                                pbar.update(fsize)
-                                REQUIREDCHUNKS.add(DISTANTFILES[fn][0])
-                            else:
-                                try:
-                                    h = getsha256(fn)
-                                except OSError as e:
-                                    tqdm.write(f"{yel}UNIX special file? Skipping: {fn}{rst}")
+                            local_file_list.append(x)
+                    total_size = sum([x[1] for x in local_file_list])
+                    hashpool = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS)  # hash modified files a little ahead of the upload loop, several files at once (hashlib releases the GIL)
+                    tohash = iter([fn for fn, fsize, mtime, isdir in local_file_list
+                                   if not (isdir or mtime is None or (fn in DISTANTFILES and DISTANTFILES[fn][1] >= mtime and DISTANTFILES[fn][2] == fsize))])
+                    hashes = dict()
+                    def hashahead():  # at most 2 * MAX_THREADS files hashed ahead, so that they are still in the page cache when uploaded
+                        while len(hashes) < 2 * MAX_THREADS:
+                            fn = next(tohash, None)
+                            if fn is None:
+                                return
+                            hashes[fn] = hashpool.submit(getsha256, fn)
+                    uploadpool = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS)
+                    connections = queue.Queue()
+                    try:
+                        with uploadpool, tqdm(total=total_size, unit_scale=True, unit_divisor=1024, dynamic_ncols=True, smoothing=0.8, unit="B", mininterval=1, desc="0 nFreezer") as pbar:
+                            pbar.workers, pbar.label = 0, "nFreezer"
+                            futures = dict()
+                            lock = threading.Lock()
+                            def recordupload(future):
+                                fn, chunkid, h = futures.pop(future)
+                                if future.exception() is not None:
+                                    tqdm.write(f'{red}Upload failed: {fn} ({future.exception()}){rst}')
+                                    return
+                                REQUIREDCHUNKS.add(chunkid)
+                                DISTANTHASHES[h] = chunkid
+                                flist.write(future.result())
+                            for fn, fsize, mtime, isdir in local_file_list:  # sizes and mtimes from the single stat() done by walk()
+                                for future in [future for future in futures if future.done()]:
+                                    recordupload(future)
+                                if isdir:
                                     pbar.update(fsize)
                                     continue
-                                if h in DISTANTHASHES:  # ex : chunk already there with same SHA256, but other filename  (case 1 : duplicate file, case 2 : renamed/moved file)
-                                    tqdm.write(f'SHS: {fn}')  # same hash, skipping
-                                    chunkid = DISTANTHASHES[h]
-                                    REQUIREDCHUNKS.add(chunkid) 
+                                if mtime is None:
+                                    tqdm.write(f"{yel}NFS: {fn}{rst}")  # not found, skipping
                                     pbar.update(fsize)
-                                    flist.write(newdistantfileblock(chunkid=chunkid, mtime=mtime, fsize=fsize, h=h, fn=fn, key=key, salt=salt))
+                                    continue
+                                distantfile = DISTANTFILES.get(fn)  # one dict lookup, then plain tuple indexing
+                                if distantfile is not None and distantfile[1] >= mtime and distantfile[2] == fsize:
+                                    tqdm.write(f'US: {fn}')  # unmodified, skipping
+                                    pbar.update(fsize)
+                                    REQUIREDCHUNKS.add(distantfile[0])
                                 else:
-                                    tqdm.write(f'{red}Up: {fn}{rst}')  # uploading
-                                    chunkid = uuid.uuid4().bytes
-                                    if fsize <= SMALL_FILE:
-                                        with sftp.open(chunkid.hex() + '.tmp', 'wb') as f_enc, open(fn, 'rb') as f:
-                                            encrypt(f, key=key, salt=salt, out=f_enc, pbar=None)
-                                            sftp.rename(chunkid.hex() + '.tmp', chunkid.hex())
-                                        REQUIREDCHUNKS.add(chunkid)
-                                        DISTANTHASHES[h] = chunkid
-                                        flist.write(newdistantfileblock(chunkid=chunkid, mtime=mtime, fsize=fsize, h=h, fn=fn, key=key, salt=salt))
+                                    try:
+                                        hashahead()
+                                        h = hashes.pop(fn).result() if fn in hashes else getsha256(fn)
+                                    except FileNotFoundError:  # deleted since walk()
+                                        tqdm.write(f"{yel}NFS: {fn}{rst}")
+                                        pbar.update(fsize)
+                                        continue
+                                    except OSError as e:
+                                        tqdm.write(f"{yel}UNIX special file? Skipping: {fn}{rst}")
                                         pbar.update(fsize)
+                                        continue
+                                    if h in DISTANTHASHES:  # ex : chunk already there with same SHA256, but other filename  (case 1 : duplicate file, case 2 : renamed/moved file)
+                                        tqdm.write(f'SHS: {fn}')  # same hash, skipping
+                                        chunkid = DISTANTHASHES[h]
+                                        REQUIREDCHUNKS.add(chunkid) 
+                                        pbar.update(fsize)
+                                        flist.write(newdistantfileblock(chunkid=chunkid, mtime=mtime, fsize=fsize, h=h, fn=fn, key=key, salt=salt))
                                     else:
-                                        thread = threading.Thread(target=threaded_upload,
-                                                                  args=(lock, fn, pbar, chunkid, flist,
-                                                                      REQUIREDCHUNKS, DISTANTHASHES,
+                                        tqdm.write(f'{red}Up: {fn}{rst}')  # uploading
+                                        chunkid = uuid.uuid4().bytes
+                                        if fsize <= SMALL_FILE:
+                                            with sftp.open(chunkname(chunkid, b64) + '.tmp', 'wb') as f_enc, open(fn, 'rb') as f:
+                                                f_enc.set_pipelined(True)
+                                                encrypt(f, key=key, salt=salt, out=f_enc, pbar=None)
+                                            sftp.rename(chunkname(chunkid, b64) + '.tmp', chunkname(chunkid, b64))
+                                            REQUIREDCHUNKS.add(chunkid)
+                                            DISTANTHASHES[h] = chunkid
+                                            flist.write(newdistantfileblock(chunkid=chunkid, mtime=mtime, fsize=fsize, h=h, fn=fn, key=key, salt=salt))
+                                            pbar.update(fsize)
+                                        else:
+                                            if len(futures) >= MAX_THREADS:  # no upload queue: the loop, and the hashes ahead of it, wait for a free thread
+                                                concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                                                for future in [future for future in futures if future.done()]:
+                                                    recordupload(future)
+                                            futures[uploadpool.submit(threaded_upload, lock, fn, pbar, chunkid, b64,
                                                                       mtime, fsize, h, key, salt,
-                                                                      host, user, sftppwd, extra_arg, remotepath),
-                                                                  daemon=False)
-                                        pbar.desc = str(int(pbar.desc[0])+1) + pbar.desc[1:]
-                                        thread.start()
-                                        threads.append(thread)
-                                        while sum([t.is_alive() for t in threads]) >= MAX_THREADS:
-                                            time.sleep(0.5)
-                        if sum([t.is_alive() for t in threads]) > 0:
-                            print("Waiting for threads to finish...")
-                        [t.join() for t in threads]
+                                                                      connections, host, user, sftppwd, extra_arg, remotepath)] = fn, chunkid, h
+                            if not all(future.done() for future in futures):
+                                print("Waiting for threads to finish...")
+                            for future in concurrent.futures.as_completed(list(futures)):
+                                recordupload(future)
+                    finally:
+                        for future in hashes.values():  # on error or Ctrl-C, don't wait for the pending hashes
+                            future.cancel()
+                        hashpool.shutdown(wait=False)
+                        closeconnections(connections)  # pooled connections closed even if the backup failed
                 print("Listing chunks to delete...")
                 delchunks = DISTANTCHUNKS - REQUIREDCHUNKS
                 if len(delchunks) > 0:
                     for chunkid in tqdm(delchunks,
                                    desc=f'Deleting {len(delchunks)} no-longer-used distant chunks... '
                                 ):
-                        sftp.remove(chunkid.hex())
+                        sftp.remove(chunkname(chunkid, b64))
             print('Backup finished.')
             break
         except paramiko.ssh_exception.AuthenticationException:
@@ -371,7 +554,7 @@ def restore(src=None, dest=None,
 
     else:
         src_cm = nullcontext()
-        src_cm.open, src_cm.chdir, src_cm.isdir = open, os.chdir, os.path.isdir
+        src_cm.open, src_cm.chdir, src_cm.isdir, src_cm.isfile = open, os.chdir, os.path.isdir, os.path.isfile
     with src_cm:
         DISTANTFILES = dict()
         dest = os.path.abspath(dest)
@@ -381,62 +564,27 @@ def restore(src=None, dest=None,
             print('src path does not exist.')
             return
         print('Restoring backup from %s: %s\nDestination local path: %s' % ('remote' if remote else 'local path', src, dest))
+        b64 = src_cm.isfile(B64MARKER)
 
         with src_cm.open('.files', 'rb') as flist:
             print("Fetching remote file list...")
-            flist = io.BytesIO(flist.read())
-
-            buf = []
-            while True:
-                l = flist.read(4)
-                if not l:
-                    break
-                length = int.from_bytes(l, byteorder='little')
-                s = flist.read(length)
-
-                if len(s) != length:
-                    print(red + 'An item of the remote file list (.files) is corrupt, ignored. Last sync interrupted?' + rst)
-                    break
-                buf.append(s)
-
-            def threaded_flist_decrypt(lock, pbar, s, encryptionpwd, DISTANTFILES):
-                """
-                decrypts flist content using multithreading
-                """
-                chunkid, mtime, fsize, h, fn = readdistantfileblock(s, encryptionpwd)
-                with lock:
-                    DISTANTFILES[fn] = [chunkid, mtime, fsize, h]
-                    if DISTANTFILES[fn][0] == NULL16BYTES:  # deleted
-                        del DISTANTFILES[fn]
-                pbar.update(len(s))
-
-            with tqdm(total=sum([len(s) for s in buf]),
-                      unit="B",
-                      dynamic_ncols=True,
-                      unit_scale=True,
-                      unit_divisor=1024,
-                      smoothing=0.1,
-                      desc="Decrypting file list") as pbar:
-                threads = []
-                lock = threading.Lock()
-                for ss in buf:
-                    if len(ss) <= SMALL_FILE:
-                        threaded_flist_decrypt(lock, pbar, ss, encryptionpwd,
-                                DISTANTFILES)
-                    else:
-                        thread = threading.Thread(target=threaded_flist_decrypt,
-                                                  args=(lock, pbar, ss,
-                                                        encryptionpwd,
-                                                        DISTANTFILES))
-                        thread.start()
-                        threads.append(thread)
-                        while sum([t.is_alive() for t in threads]) >= MAX_THREADS:
-                            time.sleep(0.5)
-                [t.join() for t in threads]
+            buf = list(flistitems(flist.read()))
+
+            key_by_salt = KDFs([s[:16] for s in buf], encryptionpwd)  # the only expensive part: done once per unique salt
+            for s in tqdm(buf,
+                          unit=" files",
+                          dynamic_ncols=True,
+                          smoothing=0.1,
+                          desc="Decrypting file list"):
+                chunkid, mtime, fsize, h, fn = readdistantfileblock(s, key_by_salt)
+                if chunkid == NULL16BYTES:  # deleted
+                    DISTANTFILES.pop(fn, None)
+                else:
+                    DISTANTFILES[fn] = (chunkid, mtime, fsize, h)
             if only_print_file_list is True:
                 if only_print_file_list is True:
                     with open("distant_file_list.txt", "a") as f:
-                        f.write(str([x["fn"] for x in DISTANTFILES]))
+                        f.write(str(list(DISTANTFILES)))
                 print("Written to file distant_file_list.txt")
                 raise SystemExit()
 
@@ -447,40 +595,49 @@ def restore(src=None, dest=None,
                     unit_scale=True,
                     unit_divisor=1024,
                     unit="B")
+        pbar.workers, pbar.label = 0, "Restoring files"
         lock = threading.Lock()
-        threads = []
+        connections = queue.Queue() if remote else None
+        futures = dict()
 
         dist_list = sorted(list( DISTANTFILES.items()),
-                            key = lambda x : x[1][2],
-                            reverse = larger_files_first)
-        for fn, [chunkid, mtime, fsize, h] in dist_list:
-            if re.match(include_regex, fn) is None:
-                tqdm.write(f"Inclusion regex mismatch: {fn}")
-                break
-            if re.match(exclude_regex, fn) is not None:
-                tqdm.write(f"Exclusion regex match: {fn}")
-                break
-            f2 = os.path.join(dest, fn).replace('\\', '/')
-            os.makedirs(os.path.dirname(f2), exist_ok=True)
-            if os.path.exists(f2) and getsha256(f2) == h:
-                tqdm.write(f'{yel}APS: {fn}{rst}')  # already present, skipping
-                continue
-            if fsize <= SMALL_FILE:
-                tqdm.write(f'{red}R: {fn}{rst}')  # restoring
-                with open(f2, 'wb') as f, src_cm.open(chunkid.hex(), 'rb') as g:
-                    decrypt(g, pwd=encryptionpwd, out=f)
-                os.utime(f2, ns=(os.stat(f2).st_atime_ns, mtime))
-                pbar.update(fsize)
-            else:
-                thread = threading.Thread(target=threaded_restore,
-                        args=(f2, lock, pbar, chunkid, mtime, fn,
-                            host, user, sftppwd, encryptionpwd, extra_arg,
-                            path, fsize))
-                thread.start()
-                pbar.desc = str(int(pbar.desc[0])+1) + pbar.desc[1:]
-                threads.append(thread)
-                while sum([t.is_alive() for t in threads]) >= MAX_THREADS:
-                    time.sleep(0.5)
+                            key = lambda x : chunkname(x[1][0], b64))  # chunks read in the order of their names on the remote: sequential directory lookups and better server-side caching
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as pool:
+                for fn, (chunkid, mtime, fsize, h) in dist_list:
+                    if re.match(include_regex, fn) is None:
+                        tqdm.write(f"Inclusion regex mismatch: {fn}")
+                        break
+                    if re.match(exclude_regex, fn) is not None:
+                        tqdm.write(f"Exclusion regex match: {fn}")
+                        break
+                    f2 = os.path.join(dest, fn).replace('\\', '/')
+                    os.makedirs(os.path.dirname(f2), exist_ok=True)
+                    try:
+                        st = os.stat(f2)
+                    except OSError:
+                        st = None
+                    if st is not None and ((st.st_mtime_ns == mtime and st.st_size == fsize) or getsha256(f2) == h):  # same mtime and size: no need to hash, as when backing up
+                        tqdm.write(f'{yel}APS: {fn}{rst}')  # already present, skipping
+                        continue
+                    if fsize <= SMALL_FILE:
+                        tqdm.write(f'{red}R: {fn}{rst}')  # restoring
+                        with open(f2, 'wb') as f, src_cm.open(chunkname(chunkid, b64), 'rb') as g:
+                            if remote:
+                                g.prefetch()
+                            decrypt(g, pwd=encryptionpwd, out=f)
+                        os.utime(f2, ns=(os.stat(f2).st_atime_ns, mtime))
+                        pbar.update(fsize)
+                    else:
+                        futures[pool.submit(threaded_restore, f2, lock, pbar, chunkid, b64, mtime, fn,
+                                    connections, host, user, sftppwd, encryptionpwd, extra_arg,
+                                    path, fsize)] = fn
+                for future in concurrent.futures.as_completed(futures):
+                    if future.exception() is not None:
+                        tqdm.write(f'{red}Restore failed: {futures[future]} ({future.exception()}){rst}')
+        finally:
+            if connections is not None:
+                closeconnections(connections)  # pooled connections closed even if the restore failed
         pbar.close()
         print('Restore finished.')
 